@@ -1,15 +1,46 @@
+from gevent import get_hub, monkey
+monkey.patch_all()
+
 import os
 import logging
+import functools
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, request, redirect, session, jsonify
+from flask import Flask, Response, request, redirect, session, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на базе orjson"""
+
+    def dumps(self, obj, **kwargs):
+        # ensure_ascii не поддерживается orjson: не-ASCII символы выводятся как UTF-8
+        option = 0
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        # object_hook и прочие параметры (сериализатор сессии Flask) — через стандартный json
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'change-me-in-production')
 CORS(app)
 
@@ -19,42 +50,258 @@ GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
 BASE_URL = os.getenv('BASE_URL', '')
 
+# URL-адреса Telegram Bot API
+TG_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+TG_SEND_URL = f"{TG_API_URL}/sendMessage"
+TG_SET_WEBHOOK_URL = f"{TG_API_URL}/setWebhook?url={BASE_URL}/webhook"
+TG_DEL_WEBHOOK_URL = f"{TG_API_URL}/deleteWebhook"
+
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+REDIRECT_URI = f"{BASE_URL}/auth/google/callback"
+
+# Конфигурация OAuth-клиента Google (неизменна после загрузки окружения)
+_CLIENT_CONFIG = {
+    "web": {
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "redirect_uris": [REDIRECT_URI]
+    }
+}
 
-# Хранилище пользователей
-users_storage = {}
+def get_flow():
+    """Новый OAuth Flow на основе общей конфигурации клиента"""
+    from google_auth_oauthlib.flow import Flow
 
-def send_telegram_message(chat_id, text):
-    """Отправка сообщения в Telegram"""
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("TELEGRAM_BOT_TOKEN не установлен")
-        return False
+    return Flow.from_client_config(_CLIENT_CONFIG, scopes=SCOPES, redirect_uri=REDIRECT_URI)
+
+REDIS_URL = os.getenv('REDIS_URL', '')
+
+class RedisUserStorage:
+    """Хранилище пользователей в Redis, общее для всех воркеров"""
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    PREFIX = 'calbot'
+    USERS_KEY = f"{PREFIX}:users"
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, user_id):
+        return f"{self.PREFIX}:user:{user_id}"
+
+    def __contains__(self, user_id):
+        return bool(self.redis.exists(self._key(user_id)))
+
+    def __getitem__(self, user_id):
+        data = self.redis.hgetall(self._key(user_id))
+        if not data:
+            raise KeyError(user_id)
+        return {
+            'credentials': orjson.loads(data['credentials']),
+            'chat_id': data.get('chat_id') or None
+        }
+
+    def __setitem__(self, user_id, value):
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(user_id), mapping={
+            'credentials': orjson.dumps(value['credentials']),
+            'chat_id': value.get('chat_id') or ''
+        })
+        pipe.sadd(self.USERS_KEY, user_id)
+        pipe.execute()
+
+    def __len__(self):
+        return self.redis.scard(self.USERS_KEY)
+
+DB_PATH = os.getenv('DB_PATH', '')
+if not DB_PATH:
+    DB_PATH = 'bot.db'
+    logger.warning("DB_PATH не задан: bot.db в рабочем каталоге не переживёт редеплой, укажите путь на подключённом томе")
+
+class SQLiteUserStorage:
+    """Хранилище пользователей в SQLite (WAL), переживающее перезапуски"""
+
+    def __init__(self, path):
+        self.path = path
+        self._execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                cred BLOB NOT NULL,
+                chat_id TEXT
+            )
+        """)
+
+    def _run(self, sql, params):
+        # Короткоживущее соединение на вызов: общий lock не нужен, WAL разрешает параллельное чтение
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def _execute(self, sql, params=()):
+        """Запрос в OS-потоке пула gevent: блокирующий sqlite3 не останавливает остальные гринлеты"""
+        return get_hub().threadpool.apply(self._run, (sql, params))
+
+    def __contains__(self, user_id):
+        return bool(self._execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)))
+
+    def __getitem__(self, user_id):
+        rows = self._execute('SELECT cred, chat_id FROM users WHERE user_id = ?', (user_id,))
+        if not rows:
+            raise KeyError(user_id)
+        cred, chat_id = rows[0]
+        return {'credentials': orjson.loads(cred), 'chat_id': chat_id}
+
+    def __setitem__(self, user_id, value):
+        self._execute(
+            'INSERT OR REPLACE INTO users (user_id, cred, chat_id) VALUES (?, ?, ?)',
+            (user_id, orjson.dumps(value['credentials']), value.get('chat_id'))
+        )
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM users')[0][0]
+
+# Хранилище пользователей
+users_storage = RedisUserStorage(REDIS_URL) if REDIS_URL else SQLiteUserStorage(DB_PATH)
+
+# Общая HTTP-сессия для Telegram API (keep-alive)
+TG_SESSION = requests.Session()
+TG_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=64))
+
+# Очередь исходящих сообщений Telegram
+outgoing_messages = queue.Queue()
+
+# Лимит Telegram (30 сообщений/с) общий для бота, поэтому делим его между воркерами gunicorn
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 2))
+TG_RATE_LIMIT = max(1, 28 // WEB_CONCURRENCY)  # сообщений в секунду на воркер
+TG_COALESCE_WINDOW = 0.5  # секунд на сбор сообщений в один чат
+TG_MAX_MESSAGE_LENGTH = 4096
+TG_SEND_WORKERS = 16  # одновременных запросов к Telegram
+
+# Полосы отправки: у каждой один поток, чат всегда попадает в одну и ту же полосу,
+# поэтому разные чаты отправляются параллельно, а сообщения одного чата — по порядку
+_send_lanes = [
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'telegram-send-{i}')
+    for i in range(TG_SEND_WORKERS)
+]
+
+def _send_lane(chat_id):
+    """Полоса отправки для чата (chat_id может прийти как int или str)"""
+    return _send_lanes[hash(str(chat_id)) % len(_send_lanes)]
+
+def _collect_batch(messages=outgoing_messages):
+    """Сбор сообщений из очереди за окно TG_COALESCE_WINDOW с группировкой по chat_id"""
+    chat_id, text = messages.get()
+    batch = {chat_id: [text]}
+    deadline = time.monotonic() + TG_COALESCE_WINDOW
+
+    while True:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            chat_id, text = messages.get(timeout=timeout)
+        except queue.Empty:
+            break
+        batch.setdefault(chat_id, []).append(text)
+
+    return batch
+
+def _coalesce(texts):
+    """Склейка сообщений одного чата с учётом лимита длины Telegram"""
+    messages = [[texts[0]]]
+    length = len(texts[0])
+    for text in texts[1:]:
+        if length + 2 + len(text) <= TG_MAX_MESSAGE_LENGTH:
+            messages[-1].append(text)
+            length += 2 + len(text)
+        else:
+            messages.append([text])
+            length = len(text)
+    return ["\n\n".join(parts) for parts in messages]
+
+def _post_message(chat_id, text):
+    """Отправка одного сообщения в Telegram"""
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = TG_SESSION.post(TG_SEND_URL, json=payload, timeout=10)
         response.raise_for_status()
-        return True
     except Exception as e:
         logger.error(f"Ошибка отправки: {e}")
+
+def _telegram_sender():
+    """Фоновая отправка сообщений из очереди в Telegram с ограничением частоты"""
+    min_interval = 1 / TG_RATE_LIMIT
+    last_sent = 0.0
+    while True:
+        for chat_id, texts in _collect_batch().items():
+            for text in _coalesce(texts):
+                delay = last_sent + min_interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                last_sent = time.monotonic()
+                _send_lane(chat_id).submit(_post_message, chat_id, text)
+
+threading.Thread(target=_telegram_sender, name='telegram-sender', daemon=True).start()
+
+def send_telegram_message(chat_id, text):
+    """Постановка сообщения в очередь отправки Telegram"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN не установлен")
         return False
 
+    outgoing_messages.put((chat_id, text))
+    return True
+
+@functools.lru_cache(maxsize=1)
+def _get_calendar_service():
+    """Ресурс Google Calendar из статического discovery-документа (общий для всех)"""
+    import httplib2
+    from googleapiclient.discovery import build
+
+    return build('calendar', 'v3', http=httplib2.Http(), static_discovery=True, cache_discovery=False)
+
+@functools.lru_cache(maxsize=1024)
+def _get_credentials(token, refresh_token):
+    """Учётные данные Google, кэшируемые по токенам пользователя"""
+    from google.oauth2.credentials import Credentials
+
+    return Credentials(
+        token=token,
+        refresh_token=refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET
+    )
+
+def _authorized_http(credentials):
+    """Новое HTTP-соединение на каждый запрос: httplib2 нельзя делить между потоками"""
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+
+    return AuthorizedHttp(credentials, http=httplib2.Http())
+
+# Кэш событий: (token, refresh_token) -> (момент истечения, события)
+EVENTS_CACHE_TTL = 60
+EVENTS_CACHE_MAXSIZE = 4096
+_events_cache = {}
+
 def get_calendar_events(credentials_dict):
     """Получение событий из Google Calendar"""
-    try:
-        from google.oauth2.credentials import Credentials
-        from googleapiclient.discovery import build
-
-        credentials = Credentials(
-            token=credentials_dict['token'],
-            refresh_token=credentials_dict.get('refresh_token'),
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=GOOGLE_CLIENT_ID,
-            client_secret=GOOGLE_CLIENT_SECRET
-        )
+    cache_key = (credentials_dict['token'], credentials_dict.get('refresh_token'))
+    cached = _events_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
 
-        service = build('calendar', 'v3', credentials=credentials)
+    try:
+        service = _get_calendar_service()
+        http = _authorized_http(_get_credentials(*cache_key))
 
         now = datetime.utcnow()
         time_min = now.isoformat() + 'Z'
@@ -67,15 +314,38 @@ def get_calendar_events(credentials_dict):
             maxResults=20,
             singleEvents=True,
             orderBy='startTime'
-        ).execute()
+        ).execute(http=http)
 
-        return events_result.get('items', [])
+        events = events_result.get('items', [])
+
+        now_ts = time.monotonic()
+        _events_cache.pop(cache_key, None)
+        if len(_events_cache) >= EVENTS_CACHE_MAXSIZE:
+            for key in [k for k, (expires, _) in _events_cache.items() if expires <= now_ts]:
+                del _events_cache[key]
+            # Если всё ещё свежее — вытесняем самые старые записи (порядок вставки)
+            while len(_events_cache) >= EVENTS_CACHE_MAXSIZE:
+                del _events_cache[next(iter(_events_cache))]
+        _events_cache[cache_key] = (now_ts + EVENTS_CACHE_TTL, events)
+
+        return events
     except Exception as e:
         logger.error(f"Ошибка получения событий: {e}")
         return []
 
 # ==================== ROUTES ====================
 
+# Страница успешной авторизации (кодируется один раз при загрузке)
+_SUCCESS_HTML = """
+<html>
+<head><title>Успешно!</title></head>
+<body style="font-family: Arial; text-align: center; padding-top: 50px;">
+    <h1>✅ Авторизация успешна!</h1>
+    <p>Можете закрыть это окно и вернуться в Telegram.</p>
+</body>
+</html>
+""".encode('utf-8')
+
 @app.route('/', methods=['GET'])
 def index():
     return jsonify({'status': 'ok', 'message': 'Calendar Bot API'}), 200
@@ -92,8 +362,6 @@ def health():
 @app.route('/auth/google', methods=['GET'])
 def auth_google():
     """Начало OAuth авторизации"""
-    from google_auth_oauthlib.flow import Flow
-
     telegram_user_id = request.args.get('user_id')
     chat_id = request.args.get('chat_id')
 
@@ -106,17 +374,7 @@ def auth_google():
     session['telegram_user_id'] = telegram_user_id
     session['chat_id'] = chat_id
 
-    client_config = {
-        "web": {
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "redirect_uris": [f"{BASE_URL}/auth/google/callback"]
-        }
-    }
-
-    flow = Flow.from_client_config(client_config, scopes=SCOPES, redirect_uri=f"{BASE_URL}/auth/google/callback")
+    flow = get_flow()
     authorization_url, state = flow.authorization_url(access_type='offline', include_granted_scopes='true', prompt='consent')
     session['state'] = state
 
@@ -125,20 +383,8 @@ def auth_google():
 @app.route('/auth/google/callback', methods=['GET'])
 def auth_google_callback():
     """Callback после OAuth авторизации"""
-    from google_auth_oauthlib.flow import Flow
-
     try:
-        client_config = {
-            "web": {
-                "client_id": GOOGLE_CLIENT_ID,
-                "client_secret": GOOGLE_CLIENT_SECRET,
-                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                "token_uri": "https://oauth2.googleapis.com/token",
-                "redirect_uris": [f"{BASE_URL}/auth/google/callback"]
-            }
-        }
-
-        flow = Flow.from_client_config(client_config, scopes=SCOPES, redirect_uri=f"{BASE_URL}/auth/google/callback")
+        flow = get_flow()
         flow.fetch_token(authorization_response=request.url)
 
         credentials = flow.credentials
@@ -157,15 +403,7 @@ def auth_google_callback():
             if chat_id:
                 send_telegram_message(chat_id, "✅ <b>Google Calendar подключён!</b>\n\nИспользуйте /events для просмотра событий.")
 
-        return """
-        <html>
-        <head><title>Успешно!</title></head>
-        <body style="font-family: Arial; text-align: center; padding-top: 50px;">
-            <h1>✅ Авторизация успешна!</h1>
-            <p>Можете закрыть это окно и вернуться в Telegram.</p>
-        </body>
-        </html>
-        """
+        return Response(_SUCCESS_HTML, mimetype='text/html')
     except Exception as e:
         logger.error(f"Ошибка авторизации: {e}")
         return f"Ошибка: {e}", 400
@@ -208,13 +446,14 @@ def telegram_webhook():
             if user_id in users_storage:
                 events = get_calendar_events(users_storage[user_id]['credentials'])
                 if events:
-                    reply = "📅 <b>Ваши события:</b>\n\n"
+                    parts = ["📅 <b>Ваши события:</b>"]
                     for event in events[:5]:
                         summary = event.get('summary', 'Без названия')
                         start = event.get('start', {})
                         start_time = start.get('dateTime', start.get('date', ''))
                         if start_time:
-                            reply += f"• {summary}\n  ⏰ {start_time[:16].replace('T', ' ')}\n\n"
+                            parts.append(f"• {summary}\n  ⏰ {start_time[:16].replace('T', ' ')}")
+                    reply = "\n\n".join(parts)
                 else:
                     reply = "📭 Нет событий на ближайшие 7 дней"
             else:
@@ -240,16 +479,13 @@ def set_webhook():
     if not TELEGRAM_BOT_TOKEN or not BASE_URL:
         return jsonify({'error': 'Missing config'}), 500
 
-    webhook_url = f"{BASE_URL}/webhook"
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook?url={webhook_url}"
-    response = requests.get(url, timeout=10)
+    response = TG_SESSION.get(TG_SET_WEBHOOK_URL, timeout=10)
     return jsonify(response.json())
 
 @app.route('/delete_webhook', methods=['GET'])
 def delete_webhook():
     """Удаление Telegram webhook"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/deleteWebhook"
-    response = requests.get(url, timeout=10)
+    response = TG_SESSION.get(TG_DEL_WEBHOOK_URL, timeout=10)
     return jsonify(response.json())
 
 if __name__ == '__main__':
@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
+app = pytest.importorskip('app')
+
+
+def test_jsonify_sorts_keys():
+    with app.app.app_context():
+        response = app.jsonify({'z': 1, 'a': 2})
+
+    assert response.get_data().rstrip() == b'{"a":2,"z":1}'
+
+
+def test_session_serializer_round_trips_tagged_values():
+    serializer = app.app.session_interface.get_signing_serializer(app.app)
+    value = {'a': (1, 2), 'b': b'x'}
+
+    with app.app.app_context():
+        assert serializer.loads(serializer.dumps(value)) == value
+
+
+def test_request_json_is_parsed():
+    client = app.app.test_client()
+
+    response = client.post('/webhook', json={'update_id': 1})
+
+    assert response.get_json() == {'ok': True}
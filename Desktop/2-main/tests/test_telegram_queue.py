@@ -0,0 +1,38 @@
+import os
+import queue
+import tempfile
+
+import pytest
+
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
+app = pytest.importorskip('app')
+
+
+def test_coalesce_joins_texts_in_order():
+    assert app._coalesce(['a', 'b', 'c']) == ['a\n\nb\n\nc']
+
+
+def test_coalesce_splits_at_telegram_limit(monkeypatch):
+    monkeypatch.setattr(app, 'TG_MAX_MESSAGE_LENGTH', 10)
+
+    assert app._coalesce(['aaaa', 'bbbb', 'cccccc', 'd']) == ['aaaa\n\nbbbb', 'cccccc\n\nd']
+
+
+def test_coalesce_keeps_oversized_text_whole(monkeypatch):
+    monkeypatch.setattr(app, 'TG_MAX_MESSAGE_LENGTH', 5)
+
+    assert app._coalesce(['x' * 8, 'y']) == ['x' * 8, 'y']
+
+
+def test_collect_batch_groups_by_chat_preserving_order(monkeypatch):
+    monkeypatch.setattr(app, 'TG_COALESCE_WINDOW', 0.05)
+    messages = queue.Queue()
+    for item in [(1, 'a'), (2, 'b'), (1, 'c'), (3, 'd'), (1, 'e')]:
+        messages.put(item)
+
+    assert app._collect_batch(messages) == {1: ['a', 'c', 'e'], 2: ['b'], 3: ['d']}
+    assert messages.empty()
+
+
+def test_send_lane_is_stable_per_chat():
+    assert app._send_lane(42) is app._send_lane('42')
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+import tempfile
+
+import pytest
+
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
+app = pytest.importorskip('app')
+
+
+def test_sqlite_storage_round_trip(tmp_path):
+    storage = app.SQLiteUserStorage(str(tmp_path / 'users.db'))
+    assert 'u1' not in storage
+    assert len(storage) == 0
+
+    storage['u1'] = {'credentials': {'token': 'a', 'refresh_token': None}, 'chat_id': '5'}
+    storage['u1'] = {'credentials': {'token': 'b', 'refresh_token': 'r'}, 'chat_id': None}
+
+    assert 'u1' in storage
+    assert len(storage) == 1
+    assert storage['u1'] == {'credentials': {'token': 'b', 'refresh_token': 'r'}, 'chat_id': None}
+
+
+def test_sqlite_storage_missing_user_raises(tmp_path):
+    storage = app.SQLiteUserStorage(str(tmp_path / 'users.db'))
+
+    with pytest.raises(KeyError):
+        storage['missing']
+
+
+def test_sqlite_storage_uses_wal(tmp_path):
+    path = str(tmp_path / 'users.db')
+    app.SQLiteUserStorage(path)
+
+    assert sqlite3.connect(path).execute('PRAGMA journal_mode').fetchone()[0] == 'wal'